@@ -9,12 +9,18 @@ from . import logger
 from . import utils
 
 from .value_list import Value, ValueList
-from .algo_block import AlgoBlock, out_block, in_block
+from .algo_block import AlgoBlock
 from .waterfall import Waterfall
 from .block import SavedBlock
 
+import numpy as np
 import pandas
-import copy
+
+try:
+    from sys import intern
+except ImportError:
+    # Python 2: intern is a builtin
+    pass
 
 _l = logger.Logger(__name__)
 
@@ -77,7 +83,55 @@ ALGO_NAMES = ValueList(
 )
 
 
-class AlgorithmParameters(object):
+def _intern_name(name):
+    """Interned name; names that cannot be interned (non-string names,
+    or unicode names under Python 2) are kept as they are"""
+    try:
+        return intern(name)
+    except TypeError:
+        return name
+
+
+def block_mask(df, keys):
+    """Boolean array of the rows of df belonging to the block keys"""
+    mask = np.ones(len(df), dtype = bool)
+    for (k, v) in keys.items():
+        mask &= (df[k] == v).to_numpy()
+    return mask
+
+
+class _Slotted(object):
+    """Base of the classes with __slots__: the pickle protocols 0 and 1
+    need an explicit state, as there is no instance __dict__"""
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict((k, getattr(self, k))
+                    for cls in type(self).__mro__
+                    for k in getattr(cls, '__slots__', ())
+                    if hasattr(self, k))
+
+    def __setstate__(self, state):
+        for (k, v) in state.items():
+            setattr(self, k, v)
+
+
+class AlgorithmParameters(_Slotted):
+    __slots__ = ('input_parameters',
+                 'algorithm',
+                 'pre_selected_blocks',
+                 'waterfall_title',
+                 'reproduce_blocks',
+                 'max_block_number',
+                 'correct_mode',
+                 'top_down_parameters',
+                 '_meas_fields',
+                 '_profit_measure')
+
+    # Fields of the json representation: all parameters starting with
+    # a dash are excluded
+    _json_fields = tuple(k for k in __slots__ if k[0] != '_')
+
     def __init__(self,
                  input_parameters,
                  algorithm,
@@ -120,16 +174,14 @@ class AlgorithmParameters(object):
         return self._profit_measure
 
     def to_json_compatible(self):
-        jo = {}
-        for (k, v) in self.__dict__.items():
-            # Exclude the private (constructed) fields
-            if k[0] != '_':
-                jo[k] = utils.to_json_compatible(v)
-        return jo
+        return dict((k, utils.to_json_compatible(getattr(self, k)))
+                    for k in self._json_fields)
+
 
 
+class Context(_Slotted):
+    __slots__ = ('df', 'params', 'block')
 
-class Context(object):
     def __init__(self, params, df):
         self.df = df
         self.params = params
@@ -137,6 +189,135 @@ class Context(object):
         self.block = make_block(params, df, {}, MIX_AND_RATE, parent = None)
 
 
+class _Perimeter(object):
+    """Rows of the input facts still in the perimeter of an algorithm,
+    and the dimensions still having several values on these rows
+
+    The input facts are never modified: the remaining rows are tracked
+    by the boolean array self.alive."""
+
+    def __init__(self, df, dims):
+        self.df = df
+        self.alive = np.ones(len(df), dtype = bool)
+
+        # Input dimensions, with interned names so that the lookups
+        # by dimension name are cheap
+        self.all_dims = tuple(_intern_name(d) for d in dims)
+
+        # Integer codes of the dimensions (see dim_codes), computed
+        # once so that filters and value counts compare small integers
+        # instead of hashing the dimension values
+        self._dim_codes = {}
+        for d in self.all_dims:
+            self.dim_codes(d)
+
+        # self.dims is the tuple of the input dimensions flagged in
+        # self._live_dim_mask, only rebuilt when a dimension is removed.
+        self._live_dim_mask = np.ones(len(self.all_dims), dtype = bool)
+        self.dims = self.all_dims
+
+        # Number of alive rows for each value (code) of the live
+        # dimensions (see remove_unnecessary_dimensions)
+        self._code_counts = {}
+
+    def dim_codes(self, d):
+        """Integer codes of the dimension d over the input facts, and the
+        values they stand for (NaN, when present, is the last value)"""
+        if d not in self._dim_codes:
+            cat = pandas.Categorical(self.df[d])
+            # The codes use the narrowest integer type (int8 for up to
+            # 127 values), which keeps the filters and counts on the
+            # codes light on memory bandwidth
+            codes = cat.codes
+            values = cat.categories
+            if (codes < 0).any():
+                # Signed type able to hold the extra code len(values)
+                dtype = np.promote_types(codes.dtype,
+                                         np.min_scalar_type(-len(values) - 1))
+                codes = np.where(codes < 0, len(values), codes).astype(dtype)
+                values = values.insert(len(values), np.nan)
+            self._dim_codes[d] = (codes, values)
+        return self._dim_codes[d]
+
+    def _code_of(self, d, v):
+        # Code of the value v of the dimension d (-1 if absent)
+        values = self._dim_codes[d][1]
+        try:
+            # NaN never compares equal, as in a pandas filter
+            return values.get_loc(v) if v == v else -1
+        except KeyError:
+            return -1
+
+    def _code_count(self, d, code):
+        # Number of alive rows with the given code (an upper bound when
+        # the counts of the dimension are not maintained)
+        counts = self._code_counts.get(d)
+        if code < 0:
+            return 0
+        return len(self.df) if counts is None else counts[code]
+
+    def block_mask(self, keys):
+        """Boolean array of the input facts belonging to the block keys"""
+        # Only the most selective key is evaluated on all the facts: the
+        # other keys are checked on the rows matching it, instead of
+        # building and ANDing one full mask per key.
+        coded_keys = []
+        other_keys = {}
+        for (k, v) in keys.items():
+            if k in self._dim_codes:
+                coded_keys.append((k, self._code_of(k, v)))
+            else:
+                other_keys[k] = v
+        if not coded_keys:
+            return block_mask(self.df, other_keys)
+
+        coded_keys.sort(key = lambda kc: self._code_count(*kc))
+        (k, code) = coded_keys[0]
+        rows = np.flatnonzero(self._dim_codes[k][0] == code)
+        for (k, code) in coded_keys[1:]:
+            rows = rows[self._dim_codes[k][0][rows] == code]
+        if other_keys:
+            rows = rows[block_mask(self.df.iloc[rows], other_keys)]
+
+        mask = np.zeros(len(self.df), dtype = bool)
+        mask[rows] = True
+        return mask
+
+    def remove_unnecessary_dimensions(self, removed = None):
+        # Remove dimensions with only one value
+        #
+        # The value counts are only computed once on the whole perimeter,
+        # then updated with the rows removed by each block (removed is a
+        # mask over the input facts).
+        removed_rows = None if removed is None else np.flatnonzero(removed)
+        if removed_rows is not None and not len(removed_rows):
+            return
+
+        removed_dims = False
+        for i in np.flatnonzero(self._live_dim_mask):
+            d = self.all_dims[i]
+            (codes, values) = self.dim_codes(d)
+            counts = self._code_counts.get(d)
+            if counts is None:
+                counts = np.bincount(codes[self.alive],
+                                     minlength = len(values))
+            elif removed_rows is not None:
+                counts -= np.bincount(codes[removed_rows],
+                                      minlength = len(values))
+
+            if np.count_nonzero(counts) == 1:
+                _l.info(_("Dimension {} has only one value: ignored").format(d))
+                self._code_counts.pop(d, None)
+                self._live_dim_mask[i] = False
+                removed_dims = True
+            else:
+                self._code_counts[d] = counts
+
+        if removed_dims:
+            self.dims = tuple(self.all_dims[i]
+                              for i in np.flatnonzero(self._live_dim_mask))
+
+
 class BaseAlgorithm(object):
 
     def __init__(self, params, df):
@@ -146,6 +327,10 @@ class BaseAlgorithm(object):
         self.correct_mode = params.correct_mode
         self.params = params
 
+        # Rows and dimensions still in the perimeter, self.df being
+        # the facts restricted to these rows
+        self._perimeter = _Perimeter(df, params.input_parameters.dims)
+
         #for b in pre_selected_blocks:
         #    self.
 
@@ -159,9 +344,7 @@ class BaseAlgorithm(object):
 
         # This is 'cleaned' when the algorithm moves forward:
         # dimensions with only one value left are removed.
-        self.dims = copy.deepcopy(self.params.input_parameters.dims)
-
-        self.__remove_unnecessary_dimensions()
+        self.dims = self._perimeter.dims
 
         # Warning:
         # This is not the input list: the revenue, contrib etc
@@ -175,10 +358,15 @@ class BaseAlgorithm(object):
 
             i = i+1
 
-            self.__apply_and_save_block(b, self.pre_selected_blocks, i)
+            self.__apply_and_save_block(b, self.pre_selected_blocks, i,
+                                        prune_dims = False)
+
+        # Done once for all the pre-selected blocks, on what is
+        # left of the perimeter
+        self.__remove_unnecessary_dimensions()
 
 
-    def __apply_and_save_block(self, b, blist, index):
+    def __apply_and_save_block(self, b, blist, index, prune_dims = True):
 
         # We save the block value to a SavedBlock
         # in order to alter the contrib_bps value
@@ -189,22 +377,12 @@ class BaseAlgorithm(object):
             index, sb.contrib_bps, sb.block_type_repr(), 100*self.ratio_to_initial,
             sb.keys))
 
-        self.correct_facts(b)
+        removed = self.correct_facts(b)
         blist.append(sb)
 
-        self.__remove_unnecessary_dimensions()
-
+        if prune_dims:
+            self.__remove_unnecessary_dimensions(removed)
 
-    def __remove_unnecessary_dimensions(self):
-        # Remove dimensions with only one value
-        new_dims = []
-        for d in self.dims:
-            vals = self.df[d].unique()
-            if len(vals) == 1:
-                _l.info(_("Dimension {} has only one value: ignored").format(d))
-            else:
-                new_dims.append(d)
-        self.dims = new_dims
 
     def log_file_caption(self):
         return None
@@ -242,6 +420,16 @@ class BaseAlgorithm(object):
         # TODO: global block
         return AlgoBlock(df, profit_meas = self.params.profit_measure)
 
+    def dim_codes(self, d):
+        return self._perimeter.dim_codes(d)
+
+    def _block_mask(self, keys):
+        return self._perimeter.block_mask(keys)
+
+    def __remove_unnecessary_dimensions(self, removed = None):
+        self._perimeter.remove_unnecessary_dimensions(removed)
+        self.dims = self._perimeter.dims
+
     def make_block(self, keys, block_type):
         return AlgoBlock(self.df,
                          profit_meas = self.params.profit_measure,
@@ -249,11 +437,14 @@ class BaseAlgorithm(object):
                          block_type = block_type,
                          parent = self.global_block)
 
+    # Returns the mask (over the input facts) of the removed rows
     def correct_facts(self, b):
         assert(b.parent == self.global_block)
 
         if self.correct_mode == 'DEL':
-            next_df = out_block(self.df, b)
+            alive = self._perimeter.alive
+            mask = self._block_mask(b.keys) & alive
+            next_df = self.df[~mask[alive]]
             next_gb = self._make_global_block(next_df)
 
             assert(utils.float_eq(next_gb.cur_revenue + b.cur_revenue,
@@ -274,6 +465,8 @@ class BaseAlgorithm(object):
 
             self.global_block = next_gb
             self.df = next_df
+            alive &= ~mask
+            return mask
 
         else:
             raise NotImplemented(_("Correction method {} is not implemented")
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, unicode_literals, print_function, division
+
+import itertools
+
+import numpy as np
+import pandas
+
+from .algo import _Perimeter, block_mask
+
+
+def _facts(n = 500, seed = 0):
+    rng = np.random.RandomState(seed)
+    df = pandas.DataFrame({
+        'a': rng.choice(['p', 'q', 'r', 's'], n),
+        'b': rng.choice(['x{}'.format(i) for i in range(12)], n),
+        'c': rng.choice([1, 2, 3], n),
+        'd': rng.choice([1.5, 2.5, np.nan], n),
+        'const': 'k',
+    })
+    df.loc[rng.rand(n) < 0.1, 'b'] = np.nan
+    return df
+
+
+def _keys(df, dims):
+    # Blocks on one or several dimensions, with values present in the
+    # facts, absent values and NaN
+    values = dict((d, list(pandas.unique(df[d])) + ['absent', 7, np.nan])
+                  for d in dims)
+    for r in range(1, 3):
+        for kdims in itertools.combinations(dims, r):
+            for kvalues in itertools.product(*(values[d] for d in kdims)):
+                yield dict(zip(kdims, kvalues))
+
+
+def test_block_mask_matches_pandas_filter():
+    df = _facts()
+    dims = ['a', 'b', 'c', 'd', 'const']
+    p = _Perimeter(df, dims)
+    for keys in _keys(df, dims):
+        assert (p.block_mask(keys) == block_mask(df, keys)).all(), keys
+
+
+def test_block_mask_with_counts_and_other_columns():
+    # Once the value counts are maintained, the keys are evaluated from
+    # the most selective one; keys on columns which are not dimensions
+    # are filtered by pandas
+    df = _facts()
+    df['e'] = np.arange(len(df)) % 5
+    p = _Perimeter(df, ['a', 'b', 'c', 'd'])
+    p.remove_unnecessary_dimensions()
+    for keys in _keys(df, ['a', 'b', 'e']):
+        assert (p.block_mask(keys) == block_mask(df, keys)).all(), keys
+
+
+def _live_dims(df, alive, dims):
+    return tuple(d for d in dims if df.loc[alive, d].nunique(dropna = False) > 1)
+
+
+def _remove_blocks(p, df, dims, seed, prune = True):
+    # Removes random one or two-key blocks of alive values, keeping the
+    # perimeter non-empty, as BaseAlgorithm.correct_facts does
+    rng = np.random.RandomState(seed)
+    for _ in range(30):
+        alive_df = df[p.alive]
+        kdims = rng.choice(dims, rng.randint(1, 3), replace = False)
+        row = alive_df.iloc[rng.randint(len(alive_df))]
+        keys = dict((d, row[d]) for d in kdims)
+        mask = p.block_mask(keys) & p.alive
+        if mask.sum() == p.alive.sum():
+            continue
+        p.alive &= ~mask
+        if prune:
+            p.remove_unnecessary_dimensions(mask)
+            assert p.dims == _live_dims(df, p.alive, dims), keys
+        yield keys
+
+
+def test_dimensions_pruned_after_each_block():
+    df = _facts(n = 60)
+    dims = ['a', 'b', 'c', 'd', 'const']
+    for seed in range(10):
+        p = _Perimeter(df, dims)
+        p.remove_unnecessary_dimensions()
+        assert p.dims == _live_dims(df, p.alive, dims)
+        assert 'const' not in p.dims
+        for keys in _remove_blocks(p, df, dims, seed):
+            # The maintained counts give the same masks
+            assert (p.block_mask(keys) == block_mask(df, keys)).all(), keys
+
+
+def test_dimensions_pruned_once_after_several_blocks():
+    # Pre-selected blocks are all removed before the first pruning
+    df = _facts(n = 60)
+    dims = ['a', 'b', 'c', 'd']
+    for seed in range(10):
+        p = _Perimeter(df, dims)
+        for _ in itertools.islice(_remove_blocks(p, df, dims, seed,
+                                                 prune = False), 3):
+            pass
+        p.remove_unnecessary_dimensions()
+        assert p.dims == _live_dims(df, p.alive, dims)
+        list(_remove_blocks(p, df, dims, seed + 100))
+
+    # Nothing removed: the dimensions are kept
+    p.remove_unnecessary_dimensions(np.zeros(len(df), dtype = bool))
+    assert p.dims == _live_dims(df, p.alive, dims)